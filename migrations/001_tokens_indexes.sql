@@ -0,0 +1,13 @@
+-- migrations/001_tokens_indexes.sql
+--
+-- Rodar uma vez, manualmente, em bancos cuja tabela `tokens` foi criada antes de
+-- idx_updated_at existir no CREATE TABLE de utils/token_store.py. Tabelas novas já
+-- nascem com o índice; o app não faz ALTER em tempo de execução.
+--
+-- idx_updated_at: get_any_company_id (ORDER BY updated_at DESC LIMIT 1).
+ALTER TABLE tokens ADD INDEX idx_updated_at (updated_at);
+
+-- Só se o banco recebeu idx_expires (company_id, expires_at) de versões anteriores
+-- do app: repete o prefixo da PRIMARY KEY (a busca por company_id já lê uma única
+-- linha) e só encarece as escritas.
+-- ALTER TABLE tokens DROP INDEX idx_expires;
@@ -4,14 +4,17 @@ from __future__ import annotations
 import io
 from typing import Any, Dict, List, Tuple
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import date, datetime
+from functools import lru_cache
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import unicodedata
 import re
 
 import streamlit as st
 
-from utils.ca_api import api_get, api_post
+from utils.ca_api import api_get, api_post, api_post_many
 from utils.token_store import has_valid_token
 from utils.errors import render_error  # opcional para logs amigáveis na UI
 
@@ -91,6 +94,11 @@ def _normalize_payment_method(raw: str) -> str:
     allowed_preview = ", ".join(sorted(list(ALLOWED_PAYMENT_METHODS))[:8]) + ", ..."
     raise ValueError(f"Forma de pagamento inválida: '{raw}'. Use valores como: {allowed_preview}")
 
+@lru_cache(maxsize=1024)
+def _parse_iso(value: str) -> date:
+    """'YYYY-MM-DD' → date (cacheado: as mesmas datas se repetem entre parcelas/pedidos)."""
+    return datetime.strptime(str(value), "%Y-%m-%d").date()
+
 # -------------------------
 # Modelo/Contrato de entrada
 # -------------------------
@@ -144,6 +152,12 @@ IDENTITY_INTERNAL = {
     "total_declarado": "total_declarado",
 }
 
+# Colunas aceitas na leitura (nomes normalizados). Demais colunas são descartadas já no read.
+_UPLOAD_COLS = frozenset(PTBR_TO_INTERNAL) | frozenset(IDENTITY_INTERNAL)
+
+def _is_upload_col(name) -> bool:
+    return _norm_colname(name) in _UPLOAD_COLS
+
 def _rename_columns_ptbr(df: pd.DataFrame) -> pd.DataFrame:
     renamed = {}
     for c in df.columns:
@@ -166,7 +180,7 @@ class VendaItem:
 
 @dataclass
 class ParcelaPagamento:
-    metodo: str            # payment_method
+    metodo: str            # payment_method (canônico, ver ALLOWED_PAYMENT_METHODS)
     valor: float           # payment_amount
     vencimento: str        # YYYY-MM-DD
 
@@ -325,13 +339,46 @@ class VendaService:
     def _only_digits(s: Any) -> str:
         return "".join(ch for ch in str(s) if ch.isdigit())
 
-    @classmethod
-    def parse_planilha(cls, file) -> pd.DataFrame:
+    @staticmethod
+    def _read_csv(file) -> pd.DataFrame:
+        """
+        CSV via leitor multi-thread do Arrow; cai para o engine padrão do pandas se falhar.
+        Todas as colunas aceitas são lidas como texto (sem inferência de tipos; preserva zeros
+        à esquerda de CPF/CNPJ) e as conversões ficam em parse_planilha.
+        Mantém dtypes numpy (sem ArrowDtype) para o restante do parsing se comportar igual.
+        """
         try:
-            df = pd.read_excel(file)
+            if hasattr(file, "seek"):
+                file.seek(0)
+            cols = [c for c in pa_csv.open_csv(file).schema.names if _is_upload_col(c)]
+            if hasattr(file, "seek"):
+                file.seek(0)
+            table = pa_csv.read_csv(file, convert_options=pa_csv.ConvertOptions(
+                column_types={c: pa.string() for c in cols},
+                include_columns=cols,
+                strings_can_be_null=True,
+            ))
+            return table.to_pandas()
         except Exception:
-            file.seek(0)
-            df = pd.read_csv(file)
+            if hasattr(file, "seek"):
+                file.seek(0)
+            return pd.read_csv(file, usecols=_is_upload_col, dtype=str)
+
+    @classmethod
+    def parse_planilha(cls, file) -> pd.DataFrame:
+        """
+        Lê a planilha (.xlsx ou .csv). `file` pode ser um caminho em disco ou um file-like.
+        """
+        name = str(getattr(file, "name", file) or "").lower()
+        if name.endswith(".csv"):
+            df = cls._read_csv(file)
+        else:
+            try:
+                # engine openpyxl (read_only) itera as linhas e para em MAX_ROWS+1:
+                # planilha gigante é rejeitada sem materializar o resto da aba
+                df = pd.read_excel(file, nrows=MAX_ROWS + 1, usecols=_is_upload_col, dtype=str)
+            except Exception:
+                df = cls._read_csv(file)
 
         # 1) Renomeia colunas PT-BR/EN para nomes internos
         df = _rename_columns_ptbr(df)
@@ -497,9 +544,26 @@ class VendaService:
         if len(pedidos) > MAX_ORDERS:
             raise ValueError(f"Limite de {MAX_ORDERS} pedidos excedido.")
 
+        # Colunas pré-processadas uma única vez (vetorizado) — sem iterrows/Series por linha
+        item_tipo = df["item_tipo"].astype(str).str.upper().str.strip().tolist()
+        item_codigo = df["item_codigo"].astype(str).str.strip().tolist()
+        item_qtd = df["item_quantidade"].astype(float).tolist()
+        item_preco = df["item_unit_price"].astype(float).tolist()
+        pag_valor = df["payment_amount"].astype(float).tolist()
+        pag_venc = df["payment_due_date"].astype(str).tolist()
+        venc_ok = pd.to_datetime(df["payment_due_date"], format="%Y-%m-%d", errors="coerce").notna().tolist()
+        pag_metodo_raw = df["payment_method"].tolist()
+        metodos_validos: Dict[Any, str | None] = {}
+        for raw in set(pag_metodo_raw):
+            try:
+                metodos_validos[raw] = _normalize_payment_method(raw)
+            except ValueError:
+                metodos_validos[raw] = None
+        grupos = df.groupby("pedido_id", sort=False).indices  # pid → posições das linhas
+
         for pid in pedidos:
-            bloco = df[df["pedido_id"] == pid]
-            r0 = bloco.iloc[0].to_dict()
+            posicoes = grupos[pid]
+            r0 = df.iloc[posicoes[0]].to_dict()
             try:
                 header = CabecalhoVenda(
                     pedido_id=pid,
@@ -524,12 +588,12 @@ class VendaService:
 
                 itens: List[VendaItem] = []
                 total_itens = 0.0
-                for _, row in bloco.iterrows():
+                for i in posicoes:
                     it = VendaItem(
-                        tipo=str(row["item_tipo"]).upper().strip(),
-                        codigo=str(row["item_codigo"]).strip(),
-                        quantidade=float(row["item_quantidade"]),
-                        unit_price=float(row["item_unit_price"]),
+                        tipo=item_tipo[i],
+                        codigo=item_codigo[i],
+                        quantidade=item_qtd[i],
+                        unit_price=item_preco[i],
                     )
                     if it.tipo not in ("PRODUTO", "SERVICO"):
                         raise ValueError(f"item_tipo inválido em {pid}: {it.tipo}")
@@ -542,15 +606,29 @@ class VendaService:
 
                 payments: List[ParcelaPagamento] = []
                 soma_pag = 0.0
-                for _, row in bloco.iterrows():
+                metodo_venda = None
+                for i in posicoes:
+                    # normaliza já na montagem: forma inválida derruba o pedido antes de qualquer HTTP
+                    metodo = metodos_validos[pag_metodo_raw[i]]
+                    if metodo is None:
+                        _normalize_payment_method(pag_metodo_raw[i])  # levanta a mensagem explicativa
                     pm = ParcelaPagamento(
-                        metodo=str(row["payment_method"]).upper().strip(),
-                        valor=float(row["payment_amount"]),
-                        vencimento=str(row["payment_due_date"]),
+                        metodo=metodo,
+                        valor=pag_valor[i],
+                        vencimento=pag_venc[i],
                     )
+                    # todos os meios de pagamento devem ser o MESMO tipo por venda (sai na 1ª divergência)
+                    if metodo_venda is None:
+                        metodo_venda = pm.metodo
+                    elif pm.metodo != metodo_venda:
+                        raise ValueError(
+                            "A venda contém múltiplas formas de pagamento. "
+                            "Agrupe por pedido_id para manter um único tipo por venda."
+                        )
                     if pm.valor <= 0:
                         raise ValueError(f"payment_amount deve ser > 0 no pedido {pid}")
-                    datetime.strptime(pm.vencimento, "%Y-%m-%d")
+                    if not venc_ok[i]:
+                        raise ValueError(f"payment_due_date inválido no pedido {pid} (use YYYY-MM-DD).")
                     soma_pag += pm.valor
                     payments.append(pm)
 
@@ -601,19 +679,8 @@ class VendaService:
         if not venda.payments:
             raise ValueError("É obrigatório informar ao menos uma parcela de pagamento.")
 
-        # Normaliza e valida meios de pagamento — todos devem ser o MESMO tipo por venda
-        metodos_norm = {
-            cls._normalize_payment_method(p.metodo)
-            for p in venda.payments
-        }
-        if None in metodos_norm:
-            raise ValueError("Forma de pagamento inválida na planilha.")
-        if len(metodos_norm) != 1:
-            raise ValueError(
-                "A venda contém múltiplas formas de pagamento. "
-                "Agrupe por pedido_id para manter um único tipo por venda."
-            )
-        tipo_pagamento = metodos_norm.pop()
+        # Meios de pagamento já chegam normalizados e únicos (validados em _montar_por_pedido)
+        tipo_pagamento = venda.payments[0].metodo
 
         # Parcelas
         parcelas = []
@@ -698,35 +765,44 @@ class VendaService:
         df = cls.parse_planilha(file)
         vendas, erros_montagem_df = cls._montar_por_pedido(df)
 
-        resultados: List[Dict[str, Any]] = []
-        for venda in vendas:
+        # resultados por coluna (evita a inferência de list[dict] no DataFrame)
+        pedido_ids: List[str] = []
+        statuses: List[str] = []
+        sale_ids: List[str | None] = []
+        mensagens: List[str] = []
+
+        # 1) Resolução de IDs/payload em série (pode criar clientes; evita corrida entre pedidos)
+        envios: List[Tuple[int, Dict[str, Any]]] = []
+        for i, venda in enumerate(vendas):
+            pedido_ids.append(venda.header.pedido_id)
+            sale_ids.append(None)
             try:
-                payload = cls._resolver_itens_e_payload(venda)
-                resp = api_post(SALES_PATH, json=payload)
-                sale_id = resp.get("id") or resp.get("identificador") or resp.get("sale_id")
-                resultados.append(
-                    {
-                        "pedido_id": venda.header.pedido_id,
-                        "status": "criada",
-                        "sale_id": sale_id,
-                        "mensagem": "Venda criada com sucesso",
-                    }
-                )
+                envios.append((i, cls._resolver_itens_e_payload(venda)))
+                statuses.append("criada")
+                mensagens.append("Venda criada com sucesso")
             except Exception as e:
-                resultados.append(
-                    {
-                        "pedido_id": venda.header.pedido_id,
-                        "status": "erro",
-                        "sale_id": None,
-                        "mensagem": str(e),
-                    }
-                )
-
-        df_result = pd.DataFrame(resultados)
+                statuses.append("erro")
+                mensagens.append(str(e))
+
+        # 2) POSTs em paralelo (limitados por latência de rede, não por CPU)
+        respostas = api_post_many([(SALES_PATH, payload) for _, payload in envios], id_only=True)
+        for (i, _), resp in zip(envios, respostas):
+            if isinstance(resp, Exception):
+                statuses[i] = "erro"
+                mensagens[i] = str(resp)
+            else:
+                sale_ids[i] = resp
+
+        df_result = pd.DataFrame({
+            "pedido_id": pedido_ids,
+            "status": statuses,
+            "sale_id": sale_ids,
+            "mensagem": mensagens,
+        })
         resumo = {
             "total_pedidos": len(vendas),
-            "sucesso": int((df_result["status"] == "criada").sum()),
-            "erros": int((df_result["status"] == "erro").sum()),
+            "sucesso": statuses.count("criada"),
+            "erros": statuses.count("erro"),
         }
 
         return {
@@ -739,30 +815,20 @@ class VendaService:
     # ---------- Auxiliares ----------
     @staticmethod
     def _infer_opcao_condicao_pagamento(data_venda: str, parcelas: List[Dict[str, Any]]) -> str:
-        from datetime import datetime as _dt
-        if not parcelas:
+        if len(parcelas) <= 1:
             return "À vista"
 
-        if len(parcelas) == 1:
-            return "À vista"
-
-        # Verifica se todas as parcelas têm o mesmo valor (duas casas)
+        # valores fora do try: valor malformado é erro de entrada, não cai no fallback
         valores = [round(float(p["valor"]), 2) for p in parcelas]
-        valores_iguais = all(abs(v - valores[0]) < 0.01 for v in valores)
-
-        if valores_iguais:
+        if all(abs(v - valores[0]) < 0.01 for v in valores):
             return f"{len(parcelas)}x"
 
         # Caso geral: offsets em dias
         try:
-            base = _dt.strptime(str(data_venda), "%Y-%m-%d").date()
-            offsets = []
-            for p in parcelas:
-                dtv = _dt.strptime(str(p["data_vencimento"]), "%Y-%m-%d").date()
-                offsets.append((dtv - base).days)
-            offsets = [str(max(0, d)) for d in offsets]
-            return ", ".join(offsets)
+            base = _parse_iso(data_venda)
+            offsets = [max(0, (_parse_iso(p["data_vencimento"]) - base).days) for p in parcelas]
         except Exception:
             # fallback seguro
             return f"{len(parcelas)}x"
 
+        return ", ".join(map(str, offsets))
@@ -1,6 +1,11 @@
 # modules/vendas/ui.py
 
 from __future__ import annotations
+import gc
+import os
+import shutil
+import tempfile
+from typing import Final
 import streamlit as st
 import pandas as pd
 from io import BytesIO
@@ -8,69 +13,141 @@ from io import BytesIO
 from modules.vendas.service import VendaService
 from utils.errors import render_error
 
+# Instruções do expander de Vendas (constante de módulo: não é realocada a cada rerun)
+_INSTRUCTIONS_MD: Final[str] = """
+### 📌 Instruções para Preenchimento da Planilha (PT-BR)
+
+**Conceito:** Preencha **uma linha por ITEM**. Para parcelar, **repita o mesmo _Número_**
+alterando apenas as colunas de pagamento (**Método**, **Valor da Parcela**, **Vencimento da Parcela**).
+O sistema irá agrupar as linhas por **Número** para montar os **ITENS** e as **PARCELAS** do pedido.
+
+**Campos obrigatórios (marcados com *)**
+- **Número***: inteiro (ex.: pode informar "PED-1001" — os dígitos serão extraídos).
+- **Data da Venda*** (YYYY-MM-DD) • **Situação***: EM_ANDAMENTO ou APROVADO .
+- **Tipo do Cliente***: FISICA ou JURIDICA
+- **Nome do Cliente*** • **Documento do Cliente***: CPF (11) / CNPJ (14) — somente dígitos
+- **Tipo do Item*** (PRODUTO/SERVICO) • **Código do Item*** (SKU/código)
+- **Quantidade*** (> 0) • **Valor Unitário*** (ponto decimal)
+- **Método de Pagamento*** (enum canônico) • **Valor da Parcela*** • **Vencimento da Parcela*** (YYYY-MM-DD)
+
+**Campos opcionais**
+- **Observações** • **Custo de Frete** • **Conta Financeira (ID)**
+- **Total declarado** (se informado, validaremos a igualdade com soma dos itens + frete)
+
+**Validações automáticas**
+- Soma das parcelas = soma(itens) + frete
+- Resolução automática de cliente/produto/serviço
+- Datas e numéricos com tratamento consistente
+
+✅ Salve como **Excel (.xlsx)** e envie abaixo.
+"""
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _modelo_bytes() -> bytes:
+    """Gera o modelo .xlsx uma vez por processo (evita reconstruir a cada rerun)."""
+    return VendaService.gerar_modelo_planilha().getvalue()
+
+_UPLOAD_SEQ_KEY = "__vendas_upload_seq"
+_RESULT_KEY = "__vendas_ultimo_resultado"
+
+_MAX_TABLE_ROWS = 500   # linhas enviadas ao navegador por tabela; o restante vai no CSV
+_TABLE_HEIGHT = 400
+
+def _preparar_resultado(resultado: dict) -> dict:
+    """
+    Executado uma vez por importação: tabelas com dtypes Arrow (serialização sem cópia
+    a cada rerun) e CSVs completos já codificados para os botões de download.
+    """
+    for key in ("resultado_df", "erros_montagem_df"):
+        df = resultado[key].convert_dtypes(dtype_backend="pyarrow")
+        resultado[key] = df
+        resultado[f"{key}_csv"] = df.to_csv(index=False).encode("utf-8")
+    return resultado
+
+def _render_tabela(resultado: dict, key: str, file_name: str) -> None:
+    df = resultado[key]
+    st.dataframe(df.head(_MAX_TABLE_ROWS), use_container_width=True, height=_TABLE_HEIGHT)
+    if len(df) > _MAX_TABLE_ROWS:
+        st.caption(f"Exibindo {_MAX_TABLE_ROWS} de {len(df)} linhas.")
+        st.download_button(
+            "⬇️ Baixar CSV completo",
+            data=resultado[f"{key}_csv"],
+            file_name=file_name,
+            mime="text/csv",
+            key=f"download_{key}",
+        )
+
+def _render_resultado(resultado: dict) -> None:
+    resumo = resultado["resumo"]
+    st.success(
+        f"✅ Pedidos: {resumo['total_pedidos']} • Criadas: {resumo['sucesso']} • Erros: {resumo['erros']}"
+    )
+
+    # Erros de montagem/validação (antes do POST)
+    if not resultado["erros_montagem_df"].empty:
+        with st.expander("⚠️ Erros de validação (antes do envio)"):
+            _render_tabela(resultado, "erros_montagem_df", "erros_validacao_vendas.csv")
+
+    st.subheader("📄 Resultado por pedido")
+    _render_tabela(resultado, "resultado_df", "resultado_vendas.csv")
+
 def render_ui():
     with st.expander("💰 Vendas — Importar em Massa"):
-        st.markdown(
-            """
-            ### 📌 Instruções para Preenchimento da Planilha (PT-BR)
-
-            **Conceito:** Preencha **uma linha por ITEM**. Para parcelar, **repita o mesmo _Número_**
-            alterando apenas as colunas de pagamento (**Método**, **Valor da Parcela**, **Vencimento da Parcela**).
-            O sistema irá agrupar as linhas por **Número** para montar os **ITENS** e as **PARCELAS** do pedido.
-
-            **Campos obrigatórios (marcados com *)**
-            - **Número***: inteiro (ex.: pode informar "PED-1001" — os dígitos serão extraídos).
-            - **Data da Venda*** (YYYY-MM-DD) • **Situação***: EM_ANDAMENTO ou APROVADO .
-            - **Tipo do Cliente***: FISICA ou JURIDICA
-            - **Nome do Cliente*** • **Documento do Cliente***: CPF (11) / CNPJ (14) — somente dígitos
-            - **Tipo do Item*** (PRODUTO/SERVICO) • **Código do Item*** (SKU/código)
-            - **Quantidade*** (> 0) • **Valor Unitário*** (ponto decimal)
-            - **Método de Pagamento*** (enum canônico) • **Valor da Parcela*** • **Vencimento da Parcela*** (YYYY-MM-DD)
-
-            **Campos opcionais**
-            - **Observações** • **Custo de Frete** • **Conta Financeira (ID)**
-            - **Total declarado** (se informado, validaremos a igualdade com soma dos itens + frete)
-
-            **Validações automáticas**
-            - Soma das parcelas = soma(itens) + frete
-            - Resolução automática de cliente/produto/serviço
-            - Datas e numéricos com tratamento consistente
-
-            ✅ Salve como **Excel (.xlsx)** e envie abaixo.
-            """
-        )
+        st.markdown(_INSTRUCTIONS_MD)
 
 
         # Download do modelo (xlsx)
-        buffer = VendaService.gerar_modelo_planilha()
         st.download_button(
             "📥 Baixar modelo (Excel)",
-            data=buffer,
+            data=_modelo_bytes(),
             file_name="modelo_vendas.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             type="primary",
         )
 
-        uploaded = st.file_uploader("📤 Enviar planilha (.xlsx ou .csv)", type=["xlsx", "csv"])
+        # A key do uploader muda após cada importação: o Streamlit descarta o UploadedFile
+        # (bytes) do session_state e um rerun não reenvia as mesmas vendas.
+        n = st.session_state.get(_UPLOAD_SEQ_KEY, 0)
+        uploaded = st.file_uploader(
+            "📤 Enviar planilha (.xlsx ou .csv)", type=["xlsx", "csv"], key=f"vendas_upload_{n}"
+        )
 
         if uploaded is not None:
             st.info("Validando e montando pedidos...")
+            path = None
+            concluido = False
             try:
-                with st.spinner("Processando vendas..."):
-                    resultado = VendaService.processar_upload(uploaded)
+                # Spool para disco: o service lê do arquivo e o buffer do upload pode ser solto
+                suffix = os.path.splitext(uploaded.name)[1].lower()
+                with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+                    uploaded.seek(0)
+                    shutil.copyfileobj(uploaded, tmp, length=1 << 20)
+                    path = tmp.name
+                uploaded.close()
+                del uploaded
 
-                resumo = resultado["resumo"]
-                st.success(
-                    f"✅ Pedidos: {resumo['total_pedidos']} • Criadas: {resumo['sucesso']} • Erros: {resumo['erros']}"
-                )
-
-                # Erros de montagem/validação (antes do POST)
-                if not resultado["erros_montagem_df"].empty:
-                    with st.expander("⚠️ Erros de validação (antes do envio)"):
-                        st.dataframe(resultado["erros_montagem_df"], use_container_width=True)
+                with st.spinner("Processando vendas..."):
+                    resultado = VendaService.processar_upload(path)
 
-                st.subheader("📄 Resultado por pedido")
-                st.dataframe(resultado["resultado_df"], use_container_width=True)
+                # só o resultado (1 linha por pedido) fica na sessão
+                st.session_state[_RESULT_KEY] = _preparar_resultado(resultado)
+                st.session_state[_UPLOAD_SEQ_KEY] = n + 1
+                del resultado
+                concluido = True
 
             except Exception as e:
                 render_error(e, context="Importar Vendas")
+            finally:
+                if path:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                gc.collect()
+
+            if concluido:
+                st.rerun()
+
+        resultado = st.session_state.get(_RESULT_KEY)
+        if resultado is not None:
+            _render_resultado(resultado)
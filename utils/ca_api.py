@@ -1,91 +1,204 @@
 # utils/ca_api.py
 
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import streamlit as st
-from utils.token_store import has_valid_token, get_tokens, get_any_company_id
-from utils.oauth import refresh_access_token
-from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson as _json  # parser 2–4× mais rápido; opcional
+except ImportError:
+    import json as _json
+from utils.token_store import is_token_row_valid, get_tokens, get_any_company_id
+from utils.oauth import refresh_access_token, REFRESH_MARGIN_SEC
+from datetime import datetime, timedelta
 
-REFRESH_MARGIN_SEC = 60  # renova 60s antes de expirar
+POST_MANY_WORKERS = 8    # POSTs simultâneos em api_post_many
+POST_MANY_429_RETRIES = 3
 API_BASE = (st.secrets.get("general", {}).get("API_BASE_URL") or "").rstrip("/")  # defina como https://api-v2.contaazul.com no secrets
 
+# Sessão HTTP única (keep-alive): reaproveita conexões TLS entre chamadas.
+# Retry de status só para GET — POST não é idempotente (evita duplicar vendas/pessoas).
+_SESSION = requests.Session()
+_SESSION.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,  # devolve a última resposta → raise_for_status/render_error
+    ),
+))
+
+# Cache de access_token no processo: company_id → (token, expires_at UTC naive, headers de auth).
+# Evita ir ao MySQL/sessão em cada chamada; invalidado em 401.
+_TOKEN_CACHE: dict[str, tuple[str, datetime, dict[str, str]]] = {}
+_TOKEN_LOCK = threading.Lock()
+
+def _bearer(token: str) -> dict[str, str]:
+    return {"Authorization": f"Bearer {token}"}
+
+def _cache_token(company_id: str, token: str | None, expires_at) -> dict[str, str] | None:
+    if not token:
+        return None
+    headers = _bearer(token)
+    if isinstance(expires_at, datetime):
+        with _TOKEN_LOCK:
+            _TOKEN_CACHE[company_id] = (token, expires_at, headers)
+    return headers
+
+def _cached_auth_headers(company_id: str) -> dict[str, str] | None:
+    with _TOKEN_LOCK:
+        cached = _TOKEN_CACHE.get(company_id)
+    if cached and cached[1] - timedelta(seconds=REFRESH_MARGIN_SEC) > datetime.utcnow():
+        return cached[2]
+    return None
+
+def _invalidate_token(company_id: str) -> None:
+    with _TOKEN_LOCK:
+        _TOKEN_CACHE.pop(company_id, None)
+
+# company_id de fallback (sessão sem company_id) — guardado na própria sessão, não no
+# processo: outra empresa conectando não pode virar o fallback de sessões já abertas
+_ANY_COMPANY_KEY = "__any_company_id"
+
+def invalidate_company_cache() -> None:
+    """Esquece o company_id de fallback desta sessão (ex.: sessão expirada/desconexão)."""
+    st.session_state.pop(_ANY_COMPANY_KEY, None)
+
 def _get_company_id_or_fallback():
-    cid = st.session_state.get("company_id")
+    cid = st.session_state.get("company_id") or st.session_state.get(_ANY_COMPANY_KEY)
     if not cid:
         cid = get_any_company_id()
+        if cid:
+            st.session_state[_ANY_COMPANY_KEY] = cid
     if not cid:
         raise RuntimeError("Nenhuma empresa conectada. Clique em Conectar e faça login.")
     return cid
 
 def _session_token_if_valid() -> str | None:
     at = st.session_state.get("__access_token")
-    exp = st.session_state.get("__expires_at")
-    if not at or not exp:
-        return None
-    try:
-        if datetime.fromisoformat(str(exp)) > datetime.utcnow():
-            return at
-    except Exception as e:
-        print(f' Error in _session_token_if_valid: {e}')
-        return None
+    exp = st.session_state.get("__expires_at")  # epoch (float), gravado em utils.oauth
+    if at and isinstance(exp, (int, float)) and exp > time.time():
+        return at
     return None
 
-def _ensure_access_token() -> tuple[str, str]:
+def _ensure_access_token() -> tuple[str, dict[str, str]]:
+    """Retorna (company_id, headers de Authorization) prontos para a requisição."""
     company_id = _get_company_id_or_fallback()
+    auth = _cached_auth_headers(company_id)
+    if auth:
+        return company_id, auth
+
     row = get_tokens(company_id)
     # tenta renovar se estiver perto de expirar ou inválido
     try:
-        if not has_valid_token(company_id):
+        if not is_token_row_valid(row):  # mesma linha: sem um 2º SELECT via has_valid_token
             refresh_access_token(company_id)
             row = get_tokens(company_id)
     except Exception:
         pass
     if row and row.get("access_token"):
-        return company_id, row["access_token"]
+        return company_id, _cache_token(company_id, row["access_token"], row.get("expires_at"))
 
     # fallback: sessão
     at = _session_token_if_valid()
     if at:
-        return company_id, at
+        return company_id, _bearer(at)
 
     # última tentativa: refresh explícito
     payload = refresh_access_token(company_id)
-    return company_id, payload["access_token"]
+    expires_at = datetime.utcnow() + timedelta(seconds=int(payload.get("expires_in", 3600)))
+    return company_id, _cache_token(company_id, payload["access_token"], expires_at)
+
+def _dumps(obj) -> bytes:
+    """Serializa o payload (orjson devolve bytes; json da stdlib devolve str)."""
+    data = _json.dumps(obj)
+    return data if isinstance(data, bytes) else data.encode()
 
 def _request(method: str, path: str, **kwargs):
     url = f"{API_BASE}{path}"
+    headers = kwargs.pop("headers", {}) or {}
+    if "json" in kwargs:
+        # serializa uma vez só (vale também para o retry)
+        kwargs["data"] = _dumps(kwargs.pop("json"))
+        headers.setdefault("Content-Type", "application/json")
+
     for attempt in (1, 2):  # 1 chamada + 1 retry após refresh
-        company_id, token = _ensure_access_token()
-        headers = kwargs.pop("headers", {}) or {}
-        headers.setdefault("Accept", "application/json")
-        headers["Authorization"] = f"Bearer {token}"
-        if "json" in kwargs:
-            headers.setdefault("Content-Type", "application/json")
-
-        resp = requests.request(method, url, headers=headers, timeout=30, **kwargs)
-        if resp.status_code == 401 and attempt == 1:
-            # força refresh e tenta de novo
-            refresh_access_token(company_id)
-            continue
+        company_id, auth = _ensure_access_token()
+
+        resp = _SESSION.request(method, url, headers={**headers, **auth}, timeout=30, **kwargs)
+        if resp.status_code == 401:
+            if attempt == 1:
+                # força refresh e tenta de novo
+                _invalidate_token(company_id)
+                refresh_access_token(company_id)
+                continue
+            invalidate_company_cache()  # 401 mesmo após refresh: sessão realmente expirada
         resp.raise_for_status()
         return resp
     raise RuntimeError("Sessão expirada. Clique em Conectar e faça login novamente.")
 
+def api_get(path: str, params: dict | None = None) -> dict:
+    r = _request("GET", path, params=params or {})
+    return _json.loads(r.content)
 
+def api_post(path: str, json: dict | None = None) -> dict:
+    r = _request("POST", path, json=json or {})
+    return _json.loads(r.content)
 
+def api_post_id(path: str, json: dict | None = None) -> str | None:
+    """
+    POST que devolve apenas o identificador do recurso criado.
+    Evita manter o dict completo da resposta quando só precisamos do id.
+    """
+    resp = _request("POST", path, json=json or {})
+    try:
+        body = _json.loads(resp.content) if resp.content else {}
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    rid = body.get("id") or body.get("identificador") or body.get("sale_id")
+    return str(rid) if rid else None
 
-def api_get(path: str, params: dict | None = None) -> dict:
-    token = _ensure_access_token()
-    url = f"{API_BASE}{path}"
-    headers = {"Authorization": f"Bearer {token}"}
-    r = requests.get(url, headers=headers, params=params or {}, timeout=30)
-    r.raise_for_status()
-    return r.json()
+def _post_with_backoff(path: str, body: dict, id_only: bool):
+    # 429 = nada foi criado → é seguro reenviar o POST com backoff exponencial
+    post = api_post_id if id_only else api_post
+    for attempt in range(POST_MANY_429_RETRIES + 1):
+        try:
+            return post(path, json=body)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status != 429 or attempt == POST_MANY_429_RETRIES:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
 
-def api_post(path: str, json: dict | None = None) -> dict:
-    token = _ensure_access_token()
-    url = f"{API_BASE}{path}"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    r = requests.post(url, headers=headers, json=json or {}, timeout=30)
-    r.raise_for_status()
-    return r.json()
+def api_post_many(items: list[tuple[str, dict]], max_workers: int = POST_MANY_WORKERS, id_only: bool = False) -> list:
+    """
+    Dispara vários POSTs em paralelo sobre a sessão HTTP compartilhada.
+    Retorna, na mesma ordem de `items`, o resultado de cada POST (dict, ou id se `id_only`)
+    ou a exceção levantada — um item com erro não interrompe os demais.
+    """
+    if not items:
+        return []
+    ctx = get_script_run_ctx()  # threads do pool precisam do contexto p/ ler st.session_state
+
+    def _init():
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+    def _one(item: tuple[str, dict]):
+        path, body = item
+        try:
+            return _post_with_backoff(path, body, id_only)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))), initializer=_init) as ex:
+        return list(ex.map(_one, items))
@@ -1,14 +1,25 @@
 # utils/errors.py
 from __future__ import annotations
-import json
 import streamlit as st
+try:
+    import orjson as _json  # parser mais rápido; opcional
+except ImportError:
+    import json as _json
 from requests import HTTPError
 
-def _try_json(text: str):
+def _parse_http(status: int, body_bytes: bytes) -> dict:
+    """
+    Caso 1 (HTTPError). Sem cache: o corpo pode trazer dados do cliente e não deve
+    ficar no cache compartilhado entre sessões; o parse só roda em caminho de erro.
+    """
+    # Tenta JSON, senão devolve texto puro
     try:
-        return json.loads(text)
+        body = _json.loads(body_bytes)
     except Exception:
-        return text
+        body = body_bytes.decode("utf-8", errors="replace")
+
+    title, message, suggestion = _map_http(status, body)
+    return {"status": status, "title": title, "message": message, "details": body, "suggestion": suggestion}
 
 def parse_backend_error(err: Exception) -> dict:
     """
@@ -17,27 +28,58 @@ def parse_backend_error(err: Exception) -> dict:
     """
     # Caso 1: Erro HTTP vindo do requests (api_get/api_post -> raise_for_status)
     if isinstance(err, HTTPError) and err.response is not None:
-        status = err.response.status_code
-        # Tenta JSON, senão devolve texto puro
-        try:
-            body = err.response.json()
-        except Exception:
-            body = _try_json(err.response.text or "")
-
-        title, message, suggestion = _map_http(status, body)
-        return {"status": status, "title": title, "message": message, "details": body, "suggestion": suggestion}
+        return _parse_http(err.response.status_code, err.response.content or b"")
 
     # Caso 2: nossos RuntimeError contendo JSON serializado (ex.: PessoaService)
-    try:
-        data = json.loads(str(err))
-        title = data.get("erro") or data.get("title") or "Erro"
-        message = data.get("mensagem") or data.get("message") or "Falha ao processar a solicitação."
-        return {"status": data.get("status_code"), "title": title, "message": message, "details": data, "suggestion": None}
-    except Exception:
-        pass
+    # Só tenta o parse se parecer um objeto JSON — exceções comuns vão direto ao fallback.
+    text = str(err)
+    if text.lstrip()[:1] == "{":
+        try:
+            data = _json.loads(text)
+            title = data.get("erro") or data.get("title") or "Erro"
+            message = data.get("mensagem") or data.get("message") or "Falha ao processar a solicitação."
+            return {"status": data.get("status_code"), "title": title, "message": message, "details": data, "suggestion": None}
+        except Exception:
+            pass
 
     # Fallback: string do erro
-    return {"status": None, "title": "Erro", "message": str(err), "details": None, "suggestion": None}
+    return {"status": None, "title": "Erro", "message": text, "details": None, "suggestion": None}
+
+# status HTTP → (título, mensagem padrão, dica de ação)
+_HTTP_MAP: dict[int, tuple[str, str, str | None]] = {
+    400: (
+        "Dados inválidos",
+        "Revise os campos obrigatórios e formatos enviados.",
+        "Confira CPF/CNPJ, CEP (8 dígitos), celular (11 dígitos) e datas (YYYY-MM-DD).",
+    ),
+    401: (
+        "Sessão expirada ou inválida",
+        "Seu token de acesso não é válido.",
+        "Clique em “Conectar com Conta Azul” para autenticar novamente.",
+    ),
+    403: (
+        "Sem permissão",
+        "Seu usuário/app não tem acesso a este recurso.",
+        "Verifique os escopos/permissions da aplicação no portal da Conta Azul.",
+    ),
+    404: ("Não encontrado", "Recurso não foi localizado.", None),
+    409: (
+        "Conflito de dados",
+        "Registro já existe (ou está em conflito).",
+        "Use outro identificador/código/documento ou edite o existente.",
+    ),
+    422: (
+        "Validação rejeitada",
+        "A API recusou os dados enviados.",
+        "Revise campos específicos apontados em 'Detalhes técnicos'.",
+    ),
+    429: (
+        "Limite de requisições",
+        "Muitas requisições em curto período.",
+        "Aguarde alguns instantes e tente novamente.",
+    ),
+}
+_SERVER_ERR = ("Serviço indisponível", "A API está instável no momento.", "Tente novamente em alguns minutos.")
 
 def _map_http(status: int, body) -> tuple[str, str, str | None]:
     """
@@ -50,47 +92,11 @@ def _map_http(status: int, body) -> tuple[str, str, str | None]:
     elif isinstance(body, str):
         msg_api = body if body.strip() else None
 
-    if status == 400:
-        return (
-            "Dados inválidos",
-            msg_api or "Revise os campos obrigatórios e formatos enviados.",
-            "Confira CPF/CNPJ, CEP (8 dígitos), celular (11 dígitos) e datas (YYYY-MM-DD).",
-        )
-    if status == 401:
-        return (
-            "Sessão expirada ou inválida",
-            msg_api or "Seu token de acesso não é válido.",
-            "Clique em “Conectar com Conta Azul” para autenticar novamente.",
-        )
-    if status == 403:
-        return (
-            "Sem permissão",
-            msg_api or "Seu usuário/app não tem acesso a este recurso.",
-            "Verifique os escopos/permissions da aplicação no portal da Conta Azul.",
-        )
-    if status == 404:
-        return ("Não encontrado", msg_api or "Recurso não foi localizado.", None)
-    if status == 409:
-        return (
-            "Conflito de dados",
-            msg_api or "Registro já existe (ou está em conflito).",
-            "Use outro identificador/código/documento ou edite o existente.",
-        )
-    if status in (422,):
-        return (
-            "Validação rejeitada",
-            msg_api or "A API recusou os dados enviados.",
-            "Revise campos específicos apontados em 'Detalhes técnicos'.",
-        )
-    if status == 429:
-        return (
-            "Limite de requisições",
-            msg_api or "Muitas requisições em curto período.",
-            "Aguarde alguns instantes e tente novamente.",
-        )
-    if status >= 500:
-        return ("Serviço indisponível", msg_api or "A API está instável no momento.", "Tente novamente em alguns minutos.")
-    return (f"Erro {status}", msg_api or "Falha ao processar a solicitação.", None)
+    entry = _HTTP_MAP.get(status)
+    if entry is None:
+        entry = _SERVER_ERR if status >= 500 else (f"Erro {status}", "Falha ao processar a solicitação.", None)
+    title, default_msg, suggestion = entry
+    return (title, msg_api or default_msg, suggestion)
 
 def render_error(err: Exception, *, context: str | None = None, show_details_toggle: bool = True) -> None:
     """
@@ -1,10 +1,41 @@
 # utils/mysql_conn.py
 
+import queue
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
 import pymysql
 import streamlit as st
 
-@st.cache_resource(show_spinner=False)
-def _get_cached_connection():
+_POOL_MAX = 8         # conexões ociosas mantidas no pool (por processo)
+_POOL_MAX_OPEN = 10   # conexões em uso ao mesmo tempo (acima disso, espera)
+_CHECKOUT_TIMEOUT = 8  # s esperando uma vaga no pool
+_PING_IDLE_SEC = 60    # conexão ociosa há mais que isso leva ping() antes de ser usada
+
+# keepalive TCP: o kernel detecta sockets meio-abertos. Não evita o wait_timeout do
+# servidor (keepalive não conta como atividade) — para isso há o ping das ociosas.
+_KEEPALIVE_OPTS = [
+    (name, value)
+    for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3))
+    if hasattr(socket, name)
+]
+if not _KEEPALIVE_OPTS and hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+    _KEEPALIVE_OPTS = [("TCP_KEEPALIVE", 30)]
+
+def _set_keepalive(conn) -> None:
+    sock = getattr(conn, "_sock", None)
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in _KEEPALIVE_OPTS:
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+    except OSError:
+        pass
+
+def _connect():
     conf = st.secrets["mysql"]
     conn = pymysql.connect(
         host=conf["host"],
@@ -19,22 +50,87 @@ def _get_cached_connection():
         read_timeout=12,
         write_timeout=12,
     )
+    _set_keepalive(conn)
     return conn
 
-def get_connection():
-    """
-    Retorna uma única conexão cacheada por sessão/processo.
-    Garante 'ping' antes de usar (reconecta automaticamente se necessário).
-    """
-    conn = _get_cached_connection()
+# Pool no módulo (não em st.cache_resource): vale também para threads sem contexto
+# do Streamlit (refresh em segundo plano) e não some com "Clear cache".
+_POOL: "queue.LifoQueue | None" = None
+_POOL_LOCK = threading.Lock()
+_OPEN_SLOTS = threading.BoundedSemaphore(_POOL_MAX_OPEN)
+
+def _get_pool() -> "queue.LifoQueue":
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                # LIFO: reaproveita a conexão usada mais recentemente (a mais "quente")
+                _POOL = queue.LifoQueue(maxsize=_POOL_MAX)
+    return _POOL
+
+def _discard(conn) -> None:
     try:
-        # Se o servidor fechou a conexão, reconecta
-        conn.ping(reconnect=True)
+        conn.close()
     except Exception:
-        # Em casos extremos, força renovar o recurso cacheado
-        # (Streamlit recria ao invalidar o hash interno)
-        _get_cached_connection.clear()  # type: ignore[attr-defined]
-        conn = _get_cached_connection()
-    return conn
+        pass
+
+def _drain_idle() -> None:
+    pool = _get_pool()
+    while True:
+        try:
+            conn, _ = pool.get_nowait()
+        except queue.Empty:
+            return
+        _discard(conn)
+
+def _acquire():
+    # ping só nas conexões paradas há mais de _PING_IDLE_SEC (podem ter caído no
+    # wait_timeout do servidor); as usadas há pouco vão direto
+    while True:
+        try:
+            conn, last_used = _get_pool().get_nowait()
+        except queue.Empty:
+            return _connect()
+        if time.monotonic() - last_used < _PING_IDLE_SEC:
+            return conn
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except Exception:
+            _discard(conn)
 
+def _release(conn) -> None:
+    try:
+        _get_pool().put_nowait((conn, time.monotonic()))
+    except queue.Full:
+        _discard(conn)
 
+@contextmanager
+def get_connection(fresh: bool = False):
+    """
+    Empresta uma conexão do pool (PyMySQL não é thread-safe: cada sessão/thread
+    usa a sua) e devolve ao sair do bloco `with`.
+    fresh=True (após erro de conexão): descarta as ociosas e abre uma nova —
+    se uma caiu por wait_timeout, as outras do pool provavelmente também.
+    """
+    if not _OPEN_SLOTS.acquire(timeout=_CHECKOUT_TIMEOUT):
+        raise RuntimeError("Pool de conexões MySQL esgotado. Tente novamente.")
+    try:
+        if fresh:
+            _drain_idle()
+            conn = _connect()
+        else:
+            conn = _acquire()
+        try:
+            yield conn
+        except pymysql.err.OperationalError:
+            # conexão possivelmente quebrada: não volta para o pool
+            _discard(conn)
+            raise
+        except BaseException:
+            _release(conn)
+            raise
+        else:
+            _release(conn)
+    finally:
+        _OPEN_SLOTS.release()
@@ -1,44 +1,93 @@
 # utils/oauth.py
 
 import base64
-import json
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
 import requests
-from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote_plus, urlencode
+try:
+    import orjson as _json  # parser 2–4× mais rápido; opcional
+except ImportError:
+    import json as _json
 from streamlit import secrets
-from utils.token_store import upsert_tokens, get_tokens
-from datetime import datetime, timedelta, timezone
+from utils.token_store import upsert_tokens, get_refresh_payload, remember_session_tokens
 import streamlit as st
 AUTH_BASE = "https://auth.contaazul.com/oauth2"
+TOKEN_URL = f"{AUTH_BASE}/token"
 SCOPES = "openid profile aws.cognito.signin.user.admin"
-
-def build_auth_url(state: str) -> str:
+REFRESH_MARGIN_SEC = 60  # renova 60s antes de expirar
+
+_b64decode = base64.urlsafe_b64decode
+
+# Sessão HTTP única p/ o servidor de auth (keep-alive: sem novo handshake TLS por refresh).
+# Retry só de conexão e de 429 (pedido recusado antes de processar): 5xx num POST de
+# code/refresh pode já ter consumido o código ou rotacionado o refresh_token.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=2,
+        read=0,  # timeout de leitura: o servidor pode já ter processado o POST → sem replay
+        backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=["POST"],
+        raise_on_status=False,  # devolve a última resposta → tratamento de invalid_grant/raise_for_status
+    ),
+))
+
+# Refresh em andamento por company_id: chamadas simultâneas esperam o mesmo resultado
+# em vez de cada uma girar o refresh_token (e invalidar o das outras).
+_INFLIGHT: dict[str, Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+@lru_cache(maxsize=1)
+def _auth_url_prefix() -> str:
+    # parte estática da URL (config): codificada uma vez; só o state muda por chamada
     query_params = {
         "response_type": "code",
         "client_id": secrets["contaazul"]["client_id"],
         "redirect_uri": secrets["contaazul"]["redirect_uri"],
-        "state": state,
         "scope": SCOPES,
     }
-    return f"{AUTH_BASE}/authorize?{urlencode(query_params)}"
+    return f"{AUTH_BASE}/authorize?{urlencode(query_params)}&state="
 
-def _basic_auth_header() -> dict:
+def build_auth_url(state: str) -> str:
+    return _auth_url_prefix() + quote_plus(state)  # mesmo escape do urlencode
+
+@lru_cache(maxsize=1)
+def _token_headers() -> dict:
+    # credenciais são estáticas: monta o header Basic uma vez por processo
     client_id = secrets["contaazul"]["client_id"]
     client_secret = secrets["contaazul"]["client_secret"]
     token = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
-    return {"Authorization": f"Basic {token}"}
+    return {
+        "Authorization": f"Basic {token}",
+        "Content-Type": "application/x-www-form-urlencoded",
+    }
+
+def _basic_auth_header() -> dict:
+    """Cópia (o dict cacheado não deve ser mutado por quem chama)."""
+    return _token_headers().copy()
 
 def _jwt_payload(jwt_token: str) -> dict:
     """
     Decodifica (sem verificação de assinatura) o payload de um JWT para extrair claims como 'sub'.
     """
     try:
-        parts = jwt_token.split(".")
-        if len(parts) != 3:
+        # JWT é ASCII: converte uma vez e trabalha só com bytes daqui em diante
+        token = jwt_token.encode("ascii")
+        # só o segmento do meio interessa: localiza os dois "." sem split()
+        first = token.find(b".")
+        second = token.find(b".", first + 1)
+        if not (first > 0 and second > first and token.find(b".", second + 1) == -1):
             return {}
+        payload_b64 = token[first + 1:second]
         # padding do base64 urlsafe
-        padded = parts[1] + "=" * (-len(parts[1]) % 4)
-        payload_json = base64.urlsafe_b64decode(padded.encode()).decode()
-        return json.loads(payload_json)
+        return _json.loads(_b64decode(payload_b64 + b"=" * (-len(payload_b64) & 3)))
     except Exception:
         return {}
 
@@ -50,12 +99,9 @@ def exchange_code_for_tokens(code: str, state: str | None = None, company_id: st
         "client_id": secrets["contaazul"]["client_id"],
         "client_secret": secrets["contaazul"]["client_secret"],
     }
-    headers = _basic_auth_header()
-    headers["Content-Type"] = "application/x-www-form-urlencoded"
-
-    resp = requests.post(f"{AUTH_BASE}/token", data=data, headers=headers, timeout=30)
+    resp = _SESSION.post(TOKEN_URL, data=data, headers=_basic_auth_header(), timeout=30)
     resp.raise_for_status()
-    payload = resp.json()
+    payload = _json.loads(resp.content)
 
     access_token = payload["access_token"]
     refresh_token = payload["refresh_token"]
@@ -85,7 +131,8 @@ def exchange_code_for_tokens(code: str, state: str | None = None, company_id: st
         st.session_state["company_id"] = derived_company_id
         st.session_state["__access_token"] = access_token
         st.session_state["__refresh_token"] = refresh_token
-        st.session_state["__expires_at"] = (datetime.utcnow() + timedelta(seconds=expires_in)).isoformat()
+        # epoch (float), já com a margem: comparação direta em ca_api._session_token_if_valid
+        st.session_state["__expires_at"] = time.time() + expires_in - REFRESH_MARGIN_SEC
     except Exception:
         pass
 
@@ -94,8 +141,48 @@ def exchange_code_for_tokens(code: str, state: str | None = None, company_id: st
 def refresh_access_token(company_id: str | None = None) -> dict:
     """
     Usa o refresh_token da company_id (ou 'default') e atualiza no MySQL.
+    Se outro refresh da mesma company_id já está em andamento, aguarda e reaproveita o resultado.
     """
-    tokens = get_tokens(company_id)
+    key = company_id or "default"
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = _INFLIGHT[key] = Future()
+
+    if owner:
+        try:
+            future.set_result(_refresh_tokens(company_id))
+        except Exception as e:
+            future.set_exception(e)
+        except BaseException:
+            # rerun/stop do Streamlit: não propaga o controle de fluxo desta sessão para as outras
+            future.set_exception(RuntimeError("Renovação de token interrompida. Tente novamente."))
+            raise
+        finally:
+            with _INFLIGHT_LOCK:
+                _INFLIGHT.pop(key, None)
+
+    payload, refresh_token, token_company_id = future.result()
+    if not owner:
+        # o dono já persistiu no MySQL; aqui só sincroniza a sessão desta thread
+        remember_session_tokens(
+            payload["access_token"], refresh_token, int(payload.get("expires_in", 3600)), token_company_id
+        )
+
+    # 👇 também atualiza o cache de sessão:
+    try:
+        st.session_state["__access_token"] = payload["access_token"]
+        st.session_state["__refresh_token"] = refresh_token
+        st.session_state["__expires_at"] = time.time() + int(payload.get("expires_in", 3600)) - REFRESH_MARGIN_SEC
+    except Exception:
+        pass
+
+    return payload
+
+def _refresh_tokens(company_id: str | None) -> tuple[dict, str, str]:
+    """Chama o endpoint de token e persiste; retorna (payload, refresh_token vigente, company_id)."""
+    tokens = get_refresh_payload(company_id)
     if not tokens:
         raise RuntimeError("Refresh token não encontrado. Faça login novamente.")
 
@@ -106,31 +193,21 @@ def refresh_access_token(company_id: str | None = None) -> dict:
         "client_id": secrets["contaazul"]["client_id"],
         "client_secret": secrets["contaazul"]["client_secret"],
     }
-    headers = _basic_auth_header()
-    headers["Content-Type"] = "application/x-www-form-urlencoded"
-
-    resp = requests.post(f"{AUTH_BASE}/token", data=data, headers=headers, timeout=30)
+    resp = _SESSION.post(TOKEN_URL, data=data, headers=_basic_auth_header(), timeout=30)
     if resp.status_code == 400 and "invalid_grant" in resp.text:
         # refresh inválido/rotacionado/revogado
         raise RuntimeError("Sessão expirada (refresh inválido). Clique em Conectar e faça login novamente.")
 
     resp.raise_for_status()
-    payload = resp.json()
+    payload = _json.loads(resp.content)
 
+    refresh_token = payload.get("refresh_token", tokens["refresh_token"])  # pode rotacionar
+    token_company_id = company_id or tokens.get("company_id")
     upsert_tokens(
         access_token=payload["access_token"],
-        refresh_token=payload.get("refresh_token", tokens["refresh_token"]),  # pode rotacionar
+        refresh_token=refresh_token,
         expires_in=int(payload.get("expires_in", 3600)),
         state=tokens.get("state"),
-        company_id=company_id or tokens.get("company_id"),
+        company_id=token_company_id,
     )
-
-    # 👇 também atualiza o cache de sessão:
-    try:
-        st.session_state["__access_token"] = payload["access_token"]
-        st.session_state["__refresh_token"] = payload.get("refresh_token", st.session_state.get("__refresh_token"))
-        st.session_state["__expires_at"] = (datetime.utcnow() + timedelta(seconds=int(payload.get("expires_in", 3600)))).isoformat()
-    except Exception:
-        pass
-    
-    return payload
+    return payload, refresh_token, token_company_id
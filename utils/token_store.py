@@ -1,18 +1,71 @@
 # utils/token_store.py
 
+import logging
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any
 from utils.mysql_conn import get_connection
 
 # 👇 ADICIONE:
 import streamlit as st
-from pymysql.err import OperationalError
+from pymysql.cursors import Cursor
+from pymysql.err import OperationalError, ProgrammingError
 
 _DEFAULT_COMPANY_ID = "default"
 _REFRESH_MARGIN_SEC = 90  # renova antes de expirar
+_RECONNECT_ERRNOS = (2006, 2013, 4031)  # gone away / lost connection / desconectado por inatividade (8.0.24+)
+_NO_SUCH_TABLE = 1146  # tabela ainda não criada (só é criada na 1ª escrita)
+
+_LOGGER = logging.getLogger(__name__)
+
+def _utcnow() -> datetime:
+    """
+    UTC naive (mesmo formato do DATETIME do MySQL). Relógio único do token_store:
+    expires_at é calculado e comparado sempre aqui, nunca com UTC_TIMESTAMP().
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+_WARN_INTERVAL_SEC = 60  # no máx. 1 aviso de tokens na tela por minuto (por sessão)
+_WARN_KEY = "__tokens_last_warning"
+
+def _warn(message: str, err: Optional[Exception] = None) -> None:
+    """
+    Loga sempre; na tela, só se a sessão não viu aviso no último minuto
+    (com MySQL instável, um st.warning por chamada vira tempestade de rerenders).
+    """
+    if err is not None:
+        _LOGGER.warning("%s Detalhe: %s", message, err)
+    else:
+        _LOGGER.warning(message)
+    try:
+        now = time.monotonic()
+        last = st.session_state.get(_WARN_KEY)
+        if last is None or now - last >= _WARN_INTERVAL_SEC:
+            st.session_state[_WARN_KEY] = now
+            st.warning(message)
+    except Exception:
+        pass
 
 # ✅ ADICIONE ESTA LINHA
-_TABLE_READY = False
+_TABLE_READY = False  # DDL feito neste processo (uma vez só, sob _TABLE_LOCK)
+_TABLE_LOCK = threading.Lock()
+
+def _execute(sql: str, args=None, fetch: bool = False):
+    """
+    Executa uma query numa conexão do pool; se a conexão estava morta
+    (2006/2013/4031), tenta uma única vez de novo numa conexão recém-aberta.
+    Cursor de tupla: as queries daqui têm forma fixa, quem chama monta o dict.
+    """
+    for attempt in (0, 1):
+        try:
+            with get_connection(fresh=bool(attempt)) as conn:
+                with conn.cursor(Cursor) as cur:
+                    cur.execute(sql, args)
+                    return cur.fetchone() if fetch else None
+        except OperationalError as e:
+            if attempt or not e.args or e.args[0] not in _RECONNECT_ERRNOS:
+                raise
 
 def _ensure_table():
     """
@@ -32,33 +85,43 @@ def _ensure_table():
         state VARCHAR(128) NULL,
         updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
                                    ON UPDATE CURRENT_TIMESTAMP,
-        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_updated_at (updated_at)
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
     """
     try:
-        with get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql)
-        _TABLE_READY = True
+        with _TABLE_LOCK:
+            if _TABLE_READY:
+                return
+            _execute(sql)
+            _TABLE_READY = True
     except OperationalError:
         st.warning("⚠️ Conexão MySQL indisponível no momento (tokens). Tentando fallback de sessão...")
         # ❗ Não levante a exceção aqui — deixe quem chamou usar o fallback.
         return
 
-def upsert_tokens(
+def _ttl(expires_in: int) -> int:
+    """Segundos até considerar o token expirado (já com a margem de renovação)."""
+    return max(60, int(expires_in) - _REFRESH_MARGIN_SEC)
+
+def remember_session_tokens(
     access_token: str,
     refresh_token: str,
     expires_in: int,
-    state: Optional[str] = None,
     company_id: Optional[str] = None,
 ) -> None:
-    company_id = company_id or _DEFAULT_COMPANY_ID
-    now = datetime.now(timezone.utc)
-    expires_at = now + timedelta(seconds=int(expires_in))
-    expires_at_ts = int(expires_at.timestamp())
+    """
+    Atualiza só a cópia de sessão (sem MySQL) — ex.: refresh feito por outra
+    sessão/thread que já persistiu os tokens.
+    """
+    _set_session_tokens(
+        company_id or _DEFAULT_COMPANY_ID,
+        access_token,
+        refresh_token,
+        _utcnow() + timedelta(seconds=_ttl(expires_in)),
+    )
 
-    # sempre atualiza fallback de sessão primeiro
-    expires_at = datetime.utcnow() + timedelta(seconds=max(60, int(expires_in) - _REFRESH_MARGIN_SEC))
+def _set_session_tokens(company_id: str, access_token: str, refresh_token: str, expires_at: datetime) -> None:
     try:
         st.session_state["tokens"] = {
             "company_id": company_id,
@@ -67,27 +130,86 @@ def upsert_tokens(
             "expires_at": expires_at,
         }
     except Exception as e:
-        st.warning(f"⚠️ Falha ao atualizar fallback de sessão (tokens). Detalhe: {e}")
-        pass
+        # sem sessão não há onde mostrar aviso: só log
+        _LOGGER.warning("Falha ao atualizar fallback de sessão (tokens): %s", e)
+
+# expires_at absoluto, calculado em _utcnow() (mesmo relógio das comparações)
+_UPSERT_HEAD = """
+    INSERT INTO tokens (company_id, access_token, refresh_token, expires_at, state)
+    VALUES """
+_UPSERT_ROW = "(%s, %s, %s, %s, %s)"
+_UPSERT_TAIL = """
+    ON DUPLICATE KEY UPDATE
+        access_token = VALUES(access_token),
+        refresh_token = VALUES(refresh_token),
+        expires_at   = VALUES(expires_at),
+        state        = VALUES(state)
+    """
+_UPSERT_BATCH = 500  # linhas por INSERT em upsert_tokens_many (folga p/ max_allowed_packet)
+
+def upsert_tokens(
+    access_token: str,
+    refresh_token: str,
+    expires_in: int,
+    state: Optional[str] = None,
+    company_id: Optional[str] = None,
+) -> None:
+    company_id = company_id or _DEFAULT_COMPANY_ID
+    # UTC naive (mesmo formato do DATETIME do MySQL), já com a margem de renovação
+    expires_at = _utcnow() + timedelta(seconds=_ttl(expires_in))
+
+    # sempre atualiza fallback de sessão primeiro
+    _set_session_tokens(company_id, access_token, refresh_token, expires_at)
 
     # tenta persistir no MySQL; se cair, não interrompe o fluxo
     try:
-        _ensure_table()
-        sql = """
-        INSERT INTO tokens (company_id, access_token, refresh_token, expires_at, state)
-        VALUES (%s, %s, %s, %s, %s)
-        ON DUPLICATE KEY UPDATE
-            access_token = VALUES(access_token),
-            refresh_token = VALUES(refresh_token),
-            expires_at   = VALUES(expires_at),
-            state        = VALUES(state)
-        """
-        with get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(sql, (company_id, access_token, refresh_token, expires_at, state))
+        _upsert_rows([(company_id, access_token, refresh_token, expires_at, state)])
     except Exception as e:
-        st.warning(f"⚠️ Não foi possível persistir tokens no MySQL (usando fallback de sessão). Detalhe: {e}")
-        return
+        _warn("⚠️ Não foi possível persistir tokens no MySQL (usando fallback de sessão).", e)
+    finally:
+        _invalidate_cached_row(company_id)
+
+def upsert_tokens_many(rows: list[tuple], batch_size: int = _UPSERT_BATCH) -> None:
+    """
+    Persiste vários tokens de uma vez (ex.: refresh em lote de várias company_id).
+    Cada linha: (company_id, access_token, refresh_token, expires_in, state).
+    Só MySQL — não mexe na cópia de sessão (que é de uma única empresa).
+    """
+    now = _utcnow()
+    rows = [
+        (company_id or _DEFAULT_COMPANY_ID, access_token, refresh_token, now + timedelta(seconds=_ttl(expires_in)), state)
+        for company_id, access_token, refresh_token, expires_in, state in rows
+    ]
+    try:
+        _upsert_rows(rows, batch_size)
+    finally:
+        for row in rows:
+            _invalidate_cached_row(row[0])
+
+def _upsert_rows(rows, batch_size: int = _UPSERT_BATCH) -> None:
+    """Cada linha: (company_id, access_token, refresh_token, expires_at, state)."""
+    _ensure_table()
+    for start in range(0, len(rows), batch_size):
+        chunk = rows[start:start + batch_size]
+        args = []
+        for row in chunk:
+            args += row
+        # VALUES multi-linha montado aqui: um INSERT (um round trip) por lote
+        _execute(_UPSERT_HEAD + ", ".join([_UPSERT_ROW] * len(chunk)) + _UPSERT_TAIL, args)
+
+# Cache de linhas de get_tokens no processo: company_id → (monotonic de expiração, linha ou None).
+# Substitui o throttle de 30s por sessão; invalidado nas escritas deste processo.
+_TOKEN_CACHE: Dict[str, tuple] = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+_TOKEN_CACHE_TTL = 30  # s
+
+def _cache_row(company_id: str, row: Optional[Dict[str, Any]], ttl: float) -> None:
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[company_id] = (time.monotonic() + ttl, row)
+
+def _invalidate_cached_row(company_id: str) -> None:
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.pop(company_id, None)
 
 def get_tokens(company_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
     company_id = company_id or _DEFAULT_COMPANY_ID
@@ -97,46 +219,98 @@ def get_tokens(company_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
     if tok:
         return tok
 
-    # 2) Throttle p/ consultas ao banco
-    key_last = "__tokens_db_last_check"
-    last_check = st.session_state.get(key_last)
-    if last_check and (_now() - last_check).total_seconds() < 30:
-        # Evita ficar batendo no banco em cada rerun
-        return None
-    st.session_state[key_last] = _now()
+    # 2) Cache do processo (vale para todas as sessões/abas da mesma empresa)
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(company_id)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
 
-    # 3) Busca no banco (uma vez a cada 30s no máx.)
+    # 3) Busca no banco — leitura não faz DDL
     try:
-        _ensure_table()
-        with get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT * FROM tokens WHERE company_id=%s", (company_id,))
-                row = cur.fetchone()
-                if row:
-                    # sincronia: joga uma cópia na sessão para próximas leituras
-                    try:
-                        st.session_state["tokens"] = {
-                            "company_id": row["company_id"],
-                            "access_token": row["access_token"],
-                            "refresh_token": row["refresh_token"],
-                            "expires_at": row["expires_at"],
-                        }
-                    except Exception:
-                        pass
-                    return row
-    except Exception:
-        st.warning("⚠️ Conexão MySQL indisponível no momento (tokens). Tentando fallback de sessão...")
+        row = _execute(
+            "SELECT company_id, access_token, refresh_token, expires_at"
+            " FROM tokens WHERE company_id=%s",
+            (company_id,),
+            fetch=True,
+        )
+        if row:
+            # sincronia: joga uma cópia na sessão para próximas leituras
+            tok = {
+                "company_id": row[0],
+                "access_token": row[1],
+                "refresh_token": row[2],
+                "expires_at": row[3],
+            }
+            try:
+                st.session_state["tokens"] = tok.copy()
+            except Exception:
+                pass
+            # até 30s, mas nunca além da expiração (token vencido não fica no cache)
+            ttl = min(_TOKEN_CACHE_TTL, (tok["expires_at"] - _utcnow()).total_seconds())
+            if ttl > 0:
+                _cache_row(company_id, tok, ttl)
+            return tok
+        _cache_row(company_id, None, _TOKEN_CACHE_TTL)  # sem linha: evita um SELECT por rerun
+    except ProgrammingError as e:
+        if not e.args or e.args[0] != _NO_SUCH_TABLE:
+            _warn("⚠️ Conexão MySQL indisponível no momento (tokens). Tentando fallback de sessão...", e)
+        else:
+            _cache_row(company_id, None, _TOKEN_CACHE_TTL)
+    except Exception as e:
+        _warn("⚠️ Conexão MySQL indisponível no momento (tokens). Tentando fallback de sessão...", e)
 
     return None
 
+def get_refresh_payload(company_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Só o necessário para o refresh (refresh_token, state, company_id), lido do banco
+    para pegar o refresh_token mais recente; cai para a cópia de sessão se o MySQL falhar.
+    """
+    company_id = company_id or _DEFAULT_COMPANY_ID
+    try:
+        row = _execute(
+            "SELECT refresh_token, state, company_id FROM tokens WHERE company_id=%s",
+            (company_id,),
+            fetch=True,
+        )
+        if row:
+            return {"refresh_token": row[0], "state": row[1], "company_id": row[2]}
+    except Exception:
+        pass
+    return _session_tokens_for(company_id)
+
+def is_token_row_valid(row: Optional[Dict[str, Any]]) -> bool:
+    """True se a linha (de get_tokens) existe e o access_token ainda não expirou."""
+    return bool(row) and row["expires_at"] > _utcnow()
+
 def has_valid_token(company_id: Optional[str] = None) -> bool:
+    company_id = company_id or _DEFAULT_COMPANY_ID
+    # cópia de sessão válida dispensa o banco
+    if is_token_row_valid(_session_tokens_for(company_id)):
+        return True
+    # linha recente no cache do processo (get_tokens de qualquer sessão): só comparar a data
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(company_id)
+    if cached and time.monotonic() < cached[0]:
+        if cached[1] is None:
+            return False  # sem linha no banco há < 30s
+        if is_token_row_valid(cached[1]):
+            return True
     try:
-        row = get_tokens(company_id)
-        if not row:
+        # só 1 linha com "1": nada de trazer os TEXT de token para comparar no Python
+        row = _execute(
+            "SELECT 1 FROM tokens WHERE company_id=%s AND expires_at > %s LIMIT 1",
+            (company_id, _utcnow()),
+            fetch=True,
+        )
+        return row is not None
+    except ProgrammingError as e:
+        if e.args and e.args[0] == _NO_SUCH_TABLE:
             return False
-        return row["expires_at"] > datetime.utcnow()
+        _warn(f"⚠️ Erro ao ler tokens: {e}")
+        return False
     except Exception as e:
-        st.warning(f"⚠️ Erro ao ler tokens: {e}")
+        _warn(f"⚠️ Erro ao ler tokens: {e}")
         return False
 
 def get_any_company_id() -> Optional[str]:
@@ -144,40 +318,32 @@ def get_any_company_id() -> Optional[str]:
     Retorna um company_id existente (o mais recentemente atualizado) para casos em que
     a sessão ainda não tenha st.session_state['company_id'] (ex.: cold start da nuvem).
     """
-    _ensure_table()
-    with get_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("SELECT company_id FROM tokens ORDER BY updated_at DESC LIMIT 1")
-            row = cur.fetchone()
-            return row["company_id"] if row else None
+    try:
+        row = _execute("SELECT company_id FROM tokens ORDER BY updated_at DESC LIMIT 1", fetch=True)
+    except ProgrammingError as e:
+        if e.args and e.args[0] == _NO_SUCH_TABLE:
+            return None
+        raise
+    return row[0] if row else None
 
 def save_tokens(company_id, access_token, refresh_token, expires_at):
     try:
         _ensure_table()
-        with get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO tokens (company_id, access_token, refresh_token, expires_at)
-                    VALUES (%s, %s, %s, %s)
-                    ON DUPLICATE KEY UPDATE
-                        access_token = VALUES(access_token),
-                        refresh_token = VALUES(refresh_token),
-                        expires_at = VALUES(expires_at)
-                """, (company_id, access_token, refresh_token, expires_at))
-                conn.commit()
+        # autocommit na conexão (mysql_conn): sem commit() extra por escrita
+        _execute("""
+            INSERT INTO tokens (company_id, access_token, refresh_token, expires_at)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                access_token = VALUES(access_token),
+                refresh_token = VALUES(refresh_token),
+                expires_at = VALUES(expires_at)
+        """, (company_id, access_token, refresh_token, expires_at))
     except Exception as e:
-        st.warning(f"⚠️ Erro ao salvar tokens no banco: {e}")
+        _warn(f"⚠️ Erro ao salvar tokens no banco: {e}")
+    _invalidate_cached_row(company_id)
 
     # ✅ Fallback via sessão (importantíssimo!)
-    st.session_state["tokens"] = {
-        "company_id": company_id,
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "expires_at": expires_at,
-    }
-
-def _now():
-    return datetime.now(tz=timezone.utc)
+    _set_session_tokens(company_id, access_token, refresh_token, expires_at)
 
 def _session_tokens_for(company_id: str) -> Optional[Dict[str, Any]]:
     tok = st.session_state.get("tokens")